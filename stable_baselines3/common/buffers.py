@@ -593,6 +593,50 @@ class DictReplayBuffer(ReplayBuffer):
             self.full = True
             self.pos = 0
 
+    def extend(
+        self,
+        obs: Dict[str, np.ndarray],
+        next_obs: Dict[str, np.ndarray],
+        action: np.ndarray,
+        reward: np.ndarray,
+        done: np.ndarray,
+        infos: List[List[Dict[str, Any]]],
+    ) -> None:
+        """
+        Add a new batch of transitions to the buffer.
+        Vectorized version of ``add()``: every array has a leading batch dimension,
+        followed by the ``n_envs`` dimension (the observations are dictionaries of such arrays).
+
+        :param obs: Observations of shape (batch_size, n_envs, *obs_shape) for each key
+        :param next_obs: Next observations, same shape as ``obs``
+        :param action: Actions of shape (batch_size, n_envs, action_dim)
+        :param reward: Rewards of shape (batch_size, n_envs)
+        :param done: Dones of shape (batch_size, n_envs)
+        :param infos: List (one element per transition) of the list of infos for each env
+        """
+        n_transitions = len(reward)
+        # Write everything at once, wrapping around the end of the buffer
+        indices = (self.pos + np.arange(n_transitions)) % self.buffer_size
+
+        # Reshape needed when using discrete observations (see `add()`),
+        # the fancy-indexed assignment copies the data
+        for key in self.observations.keys():
+            shape = (n_transitions, self.n_envs) + self.obs_shape[key]
+            self.observations[key][indices] = np.asarray(obs[key]).reshape(shape)
+            self.next_observations[key][indices] = np.asarray(next_obs[key]).reshape(shape)
+
+        self.actions[indices] = np.asarray(action).reshape((n_transitions, self.n_envs, self.action_dim))
+        self.rewards[indices] = np.asarray(reward).reshape((n_transitions, self.n_envs))
+        self.dones[indices] = np.asarray(done).reshape((n_transitions, self.n_envs))
+
+        if self.handle_timeout_termination:
+            self.timeouts[indices] = np.array(
+                [[info.get("TimeLimit.truncated", False) for info in env_infos] for env_infos in infos]
+            )
+
+        self.full = self.full or self.pos + n_transitions >= self.buffer_size
+        self.pos = (self.pos + n_transitions) % self.buffer_size
+
     def sample(self, batch_size: int, env: Optional[VecNormalize] = None) -> DictReplayBufferSamples:
         """
         Sample elements from the replay buffer.
@@ -231,6 +231,18 @@ class OffPolicyAlgorithm(BaseAlgorithm):
         # Convert train freq parameter to TrainFreq object
         self._convert_train_freq()
 
+    def set_random_seed(self, seed: Optional[int] = None) -> None:
+        """
+        Set the seed of the pseudo-random generators
+        (python, numpy, pytorch, gym, action_space, HER replay buffer)
+
+        :param seed:
+        """
+        super(OffPolicyAlgorithm, self).set_random_seed(seed)
+        # The HER replay buffer has its own random generator
+        if seed is not None and isinstance(self.replay_buffer, HerReplayBuffer):
+            self.replay_buffer.seed(seed)
+
     def save_replay_buffer(self, path: Union[str, pathlib.Path, io.BufferedIOBase]) -> None:
         """
         Save the replay buffer as a pickle file.
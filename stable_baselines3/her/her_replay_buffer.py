@@ -1,6 +1,10 @@
+import mmap
+import os
+import shutil
+import tempfile
 import warnings
-from collections import deque
-from typing import Any, Dict, List, Optional, Tuple, Union
+import weakref
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import numpy as np
 import torch as th
@@ -67,6 +71,16 @@ class HerReplayBuffer(DictReplayBuffer):
     :param handle_timeout_termination: Handle timeout termination (due to timelimit)
         separately and treat the task as infinite horizon task.
         https://github.com/DLR-RM/stable-baselines3/issues/284
+    :param compute_reward_fn: Vectorized reward function ``(achieved_goal, desired_goal, infos) -> rewards``
+        used to relabel the transitions. If not specified, ``env.compute_reward()`` is called through the VecEnv
+        (which requires inter-process communication when using a ``SubprocVecEnv``).
+        It must be picklable to save the replay buffer.
+    :param storage_dir: If specified, the transitions are stored in memory-mapped files (``np.memmap``)
+        created in a new sub-folder of this directory, instead of being kept in RAM.
+        This allows to use buffers larger than the available memory.
+        The sub-folder is removed when the buffer is garbage collected.
+        Note: when saving the buffer, the content of the files is written to the pickle
+        and it is loaded back in RAM (the files are not reused).
     """
 
     def __init__(
@@ -80,10 +94,15 @@ class HerReplayBuffer(DictReplayBuffer):
         goal_selection_strategy: Union[GoalSelectionStrategy, str] = "future",
         online_sampling: bool = True,
         handle_timeout_termination: bool = True,
+        compute_reward_fn: Optional[Callable[[np.ndarray, np.ndarray, np.ndarray], np.ndarray]] = None,
+        storage_dir: Optional[str] = None,
     ):
 
         super(HerReplayBuffer, self).__init__(buffer_size, env.observation_space, env.action_space, device, env.num_envs)
 
+        # Fail early instead of deep inside `add()`/`sample()`
+        assert env.num_envs == 1, f"HerReplayBuffer only supports a single environment for now, not {env.num_envs}"
+
         # convert goal_selection_strategy into GoalSelectionStrategy if string
         if isinstance(goal_selection_strategy, str):
             self.goal_selection_strategy = KEY_TO_GOAL_STRATEGY[goal_selection_strategy.lower()]
@@ -118,6 +137,21 @@ class HerReplayBuffer(DictReplayBuffer):
         # see https://github.com/DLR-RM/stable-baselines3/issues/284
         self.handle_timeout_termination = handle_timeout_termination
 
+        self.compute_reward_fn = compute_reward_fn
+
+        self.storage_dir = storage_dir
+        self.storage_path = None
+        if storage_dir is not None:
+            # Use a dedicated folder so several buffers can share the same storage directory
+            os.makedirs(storage_dir, exist_ok=True)
+            self.storage_path = tempfile.mkdtemp(prefix="her_buffer_", dir=storage_dir)
+            # Remove the files once the buffer is garbage collected (or at exit)
+            weakref.finalize(self, shutil.rmtree, self.storage_path, True)
+
+        # Dedicated (and faster) random generator for sampling,
+        # seeded from the global one so results stay reproducible when a seed is set
+        self.seed()
+
         # buffer with episodes
         # number of episodes which can be stored until buffer size is reached
         self.max_episode_stored = self.buffer_size // self.max_episode_length
@@ -141,15 +175,62 @@ class HerReplayBuffer(DictReplayBuffer):
             "next_desired_goal": (self.env.num_envs,) + self.goal_shape,
             "done": (1,),
         }
+        # dtype for buffer initialization, dones are stored as booleans (4x less memory than float32)
+        input_dtype = {key: np.float32 for key in input_shape.keys()}
+        input_dtype["done"] = np.bool_
+        # observations and goals are stored with the dtype of their space, as in the ``DictReplayBuffer``
+        # (e.g. images are stored as uint8, 4x less memory than float32),
+        # they are converted to float by the policy
+        obs_dtype = self.env.observation_space.spaces["observation"].dtype
+        goal_dtype = self.env.observation_space.spaces["achieved_goal"].dtype
+        for key in ["observation", "next_obs"]:
+            input_dtype[key] = obs_dtype
+        for key in ["achieved_goal", "desired_goal", "next_achieved_goal", "next_desired_goal"]:
+            input_dtype[key] = goal_dtype
+
         self._observation_keys = ["observation", "achieved_goal", "desired_goal"]
         self._buffer = {
-            key: np.zeros((self.max_episode_stored, self.max_episode_length, *dim), dtype=np.float32)
+            key: self._allocate_storage(key, (self.max_episode_stored, self.max_episode_length, *dim), input_dtype[key])
             for key, dim in input_shape.items()
         }
+        self._flat_buffer = self._get_flat_buffer()
         # Store info dicts are it can be used to compute the reward (e.g. continuity cost)
-        self.info_buffer = [deque(maxlen=self.max_episode_length) for _ in range(self.max_episode_stored)]
+        # use an array of objects so they can be gathered with the same indices as the transitions
+        self.info_buffer = np.empty((self.max_episode_stored, self.max_episode_length, self.env.num_envs), dtype=object)
         # episode length storage, needed for episodes which has less steps than the maximum length
         self.episode_lengths = np.zeros(self.max_episode_stored, dtype=np.int64)
+        # Total number of transitions stored, updated with the episode lengths
+        self.n_transitions_stored = 0
+
+    def _allocate_storage(self, key: str, shape: Tuple[int, ...], dtype: np.dtype) -> np.ndarray:
+        """
+        Allocate the (zero-initialized) storage for one key of the buffer,
+        either in RAM or in a memory-mapped file when ``storage_dir`` is specified.
+
+        :param key: Name of the stored quantity, used as file name
+        :param shape: Shape of the array
+        :param dtype: Type of the array
+        :return: The allocated array
+        """
+        if self.storage_dir is None:
+            return np.zeros(shape, dtype=dtype)
+
+        with open(os.path.join(self.storage_path, f"{key}.dat"), "w+b") as file_handler:
+            # The mapping stays valid after the file is closed
+            buffer = np.memmap(file_handler, dtype=dtype, mode="w+", shape=shape)
+        # Transitions are sampled at random, so read-ahead of the pages is useless (Python 3.8+ only)
+        if hasattr(mmap, "MADV_RANDOM"):
+            buffer._mmap.madvise(mmap.MADV_RANDOM)
+        return buffer
+
+    def _get_flat_buffer(self) -> Dict[str, np.ndarray]:
+        """
+        Create views of the storage where the episode and transition dimensions are flattened,
+        so transitions can be gathered using a single index (see ``_sample_transitions()``).
+
+        :return: The flattened views of the buffer (no data is copied)
+        """
+        return {key: buffer.reshape(-1, *buffer.shape[2:]) for key, buffer in self._buffer.items()}
 
     def __getstate__(self) -> Dict[str, Any]:
         """
@@ -157,10 +238,15 @@ class HerReplayBuffer(DictReplayBuffer):
 
         Excludes self.env, as in general Env's may not be pickleable.
         Note: when using offline sampling, this will also save the offline replay buffer.
+        The content of memory-mapped storage is saved too and is loaded back in RAM.
         """
         state = self.__dict__.copy()
         # these attributes are not pickleable
         del state["env"]
+        # the memory-mapped files are not used after loading (and are removed with this buffer)
+        state["storage_path"] = None
+        # the views would be saved (and loaded) as copies of the buffer
+        del state["_flat_buffer"]
         return state
 
     def __setstate__(self, state: Dict[str, Any]) -> None:
@@ -171,9 +257,34 @@ class HerReplayBuffer(DictReplayBuffer):
 
         :param state:
         """
+        # Default values of the attributes missing from buffers saved with SB3 <= 1.4.0
+        state.setdefault("compute_reward_fn", None)
+        state.setdefault("n_transitions_stored", int(np.sum(state["episode_lengths"])))
+        state.setdefault("storage_dir", None)
+        state.setdefault("storage_path", None)
         self.__dict__.update(state)
         assert "env" not in state
         self.env = None
+        self._flat_buffer = self._get_flat_buffer()
+        if "_rng" not in state:
+            self.seed()
+        # Buffers saved with SB3 <= 1.4.0 store the infos in a list of deques (one per episode)
+        if isinstance(self.info_buffer, list):
+            info_buffer = np.empty((self.max_episode_stored, self.max_episode_length, self.n_envs), dtype=object)
+            for episode_idx, episode_infos in enumerate(self.info_buffer):
+                for transition_idx, infos in enumerate(episode_infos):
+                    info_buffer[episode_idx, transition_idx] = infos
+            self.info_buffer = info_buffer
+
+    def seed(self, seed: Optional[int] = None) -> None:
+        """
+        Seed the random generator used to sample the transitions.
+
+        :param seed: If not specified, the seed is drawn from the global numpy random generator.
+        """
+        if seed is None:
+            seed = np.random.randint(2 ** 31 - 1)
+        self._rng = np.random.Generator(np.random.SFC64(seed))
 
     def set_env(self, env: VecEnv) -> None:
         """
@@ -186,6 +297,20 @@ class HerReplayBuffer(DictReplayBuffer):
 
         self.env = env
 
+    def to_torch(self, array: np.ndarray, copy: bool = True) -> th.Tensor:
+        """
+        Convert a numpy array to a PyTorch tensor.
+        When the buffer device is a GPU, the data is first copied to page-locked (pinned) memory
+        so the transfer to the device is asynchronous.
+
+        :param array:
+        :param copy: Whether to copy or not the data (the data is always copied when using a GPU)
+        :return:
+        """
+        if th.device(self.device).type == "cuda":
+            return th.from_numpy(array).pin_memory().to(self.device, non_blocking=True)
+        return super(HerReplayBuffer, self).to_torch(array, copy=copy)
+
     def _get_samples(self, batch_inds: np.ndarray, env: Optional[VecNormalize] = None) -> DictReplayBufferSamples:
         """
         Abstract method from base class.
@@ -255,18 +380,23 @@ class HerReplayBuffer(DictReplayBuffer):
 
         elif self.goal_selection_strategy == GoalSelectionStrategy.FUTURE:
             # replay with random state which comes from the same episode and was observed after current transition
-            transitions_indices = np.random.randint(
-                transitions_indices[her_indices] + 1, self.episode_lengths[her_episode_indices]
-            )
+            # Note: scaling a uniform sample is much faster than `randint()` with a different range per element
+            low = transitions_indices[her_indices] + 1
+            high = self.episode_lengths[her_episode_indices]
+            transitions_indices = low + (self._rng.random(len(her_episode_indices)) * (high - low)).astype(np.int64)
 
         elif self.goal_selection_strategy == GoalSelectionStrategy.EPISODE:
             # replay with random state which comes from the same episode as current transition
-            transitions_indices = np.random.randint(self.episode_lengths[her_episode_indices])
+            transitions_indices = (
+                self._rng.random(len(her_episode_indices)) * self.episode_lengths[her_episode_indices]
+            ).astype(np.int64)
 
         else:
             raise ValueError(f"Strategy {self.goal_selection_strategy} for sampling goals not supported!")
 
-        return self._buffer["achieved_goal"][her_episode_indices, transitions_indices]
+        # gather in the flattened (episode, transition) dimension, see `_sample_transitions()`
+        flat_indices = her_episode_indices * self.max_episode_length + transitions_indices
+        return np.take(self._flat_buffer["achieved_goal"], flat_indices, axis=0)
 
     def _sample_transitions(
         self,
@@ -289,19 +419,19 @@ class HerReplayBuffer(DictReplayBuffer):
             # Do not sample the episode with index `self.pos` as the episode is invalid
             if self.full:
                 episode_indices = (
-                    np.random.randint(1, self.n_episodes_stored, batch_size) + self.pos
+                    self._rng.integers(1, self.n_episodes_stored, batch_size) + self.pos
                 ) % self.n_episodes_stored
             else:
-                episode_indices = np.random.randint(0, self.n_episodes_stored, batch_size)
+                episode_indices = self._rng.integers(0, self.n_episodes_stored, batch_size)
             # A subset of the transitions will be relabeled using HER algorithm
-            her_indices = np.arange(batch_size)[: int(self.her_ratio * batch_size)]
+            her_indices = np.arange(int(self.her_ratio * batch_size))
         else:
             assert maybe_vec_env is None, "Transitions must be stored unnormalized in the replay buffer"
             assert n_sampled_goal is not None, "No n_sampled_goal specified for offline sampling of HER transitions"
             # Offline sampling: there is only one episode stored
             episode_length = self.episode_lengths[0]
             # we sample n_sampled_goal per timestep in the episode (only one is stored).
-            episode_indices = np.tile(0, (episode_length * n_sampled_goal))
+            episode_indices = np.zeros(episode_length * n_sampled_goal, dtype=np.int64)
             # we only sample virtual transitions
             # as real transitions are already stored in the replay buffer
             her_indices = np.arange(len(episode_indices))
@@ -318,7 +448,7 @@ class HerReplayBuffer(DictReplayBuffer):
 
         if online_sampling:
             # Select which transitions to use
-            transitions_indices = np.random.randint(ep_lengths)
+            transitions_indices = self._rng.integers(ep_lengths)
         else:
             if her_indices.size == 0:
                 # Episode of one timestep, not enough for using the "future" strategy
@@ -328,31 +458,30 @@ class HerReplayBuffer(DictReplayBuffer):
                 # Repeat every transition index n_sampled_goals times
                 # to sample n_sampled_goal per timestep in the episode (only one is stored).
                 # Now with the corrected episode length when using "future" strategy
-                transitions_indices = np.tile(np.arange(ep_lengths[0]), n_sampled_goal)
-                episode_indices = episode_indices[transitions_indices]
+                transitions_indices = np.arange(ep_lengths[0] * n_sampled_goal) % ep_lengths[0]
+                # all the transitions come from the same episode (index 0)
+                episode_indices = episode_indices[: len(transitions_indices)]
                 her_indices = np.arange(len(episode_indices))
 
         # get selected transitions
-        transitions = {key: self._buffer[key][episode_indices, transitions_indices].copy() for key in self._buffer.keys()}
+        # The (episode, transition) pairs are converted once to an index in the flattened
+        # (max_episode_stored * max_episode_length) dimension, shared by all the keys.
+        # Note: `np.take()` is faster than advanced indexing and returns a copy,
+        # so the relabeling below does not modify the content of the buffer
+        flat_indices = episode_indices * self.max_episode_length + transitions_indices
+        transitions = {key: np.take(buffer, flat_indices, axis=0) for key, buffer in self._flat_buffer.items()}
 
         # sample new desired goals and relabel the transitions
         new_goals = self.sample_goals(episode_indices, her_indices, transitions_indices)
         transitions["desired_goal"][her_indices] = new_goals
 
-        # Convert info buffer to numpy array
-        transitions["info"] = np.array(
-            [
-                self.info_buffer[episode_idx][transition_idx]
-                for episode_idx, transition_idx in zip(episode_indices, transitions_indices)
-            ]
-        )
+        transitions["info"] = self.info_buffer[episode_indices, transitions_indices]
 
         # Edge case: episode of one timesteps with the future strategy
         # no virtual transition can be created
         if len(her_indices) > 0:
             # Vectorized computation of the new reward
-            transitions["reward"][her_indices, 0] = self.env.env_method(
-                "compute_reward",
+            compute_reward_args = (
                 # the new state depends on the previous state and action
                 # s_{t+1} = f(s_t, a_t)
                 # so the next_achieved_goal depends also on the previous state and action
@@ -364,30 +493,41 @@ class HerReplayBuffer(DictReplayBuffer):
                 transitions["desired_goal"][her_indices, 0],
                 transitions["info"][her_indices, 0],
             )
+            if self.compute_reward_fn is not None:
+                # Compute the reward in the current process, without going through the VecEnv
+                transitions["reward"][her_indices, 0] = self.compute_reward_fn(*compute_reward_args)
+            else:
+                transitions["reward"][her_indices, 0] = self.env.env_method("compute_reward", *compute_reward_args)
 
-        # concatenate observation with (desired) goal
-        observations = self._normalize_obs(transitions, maybe_vec_env)
+        # Only pass the observation keys to the normalization (`VecNormalize` copies its input)
+        # and remove the env dimension beforehand when sampling online (we are using only one env for now)
+        env_index = 0 if online_sampling else slice(None)
+        observations = {key: transitions[key][:, env_index] for key in self._observation_keys}
 
         # HACK to make normalize obs and `add()` work with the next observation
         next_observations = {
-            "observation": transitions["next_obs"],
-            "achieved_goal": transitions["next_achieved_goal"],
+            "observation": transitions["next_obs"][:, env_index],
+            "achieved_goal": transitions["next_achieved_goal"][:, env_index],
             # The desired goal for the next observation must be the same as the previous one
-            "desired_goal": transitions["desired_goal"],
+            # (copied so the observations and next observations do not share memory)
+            "desired_goal": transitions["desired_goal"][:, env_index].copy(),
         }
+        observations = self._normalize_obs(observations, maybe_vec_env)
         next_observations = self._normalize_obs(next_observations, maybe_vec_env)
 
         if online_sampling:
-            next_obs = {key: self.to_torch(next_observations[key][:, 0, :]) for key in self._observation_keys}
+            # All the arrays were allocated when gathering the transitions (they do not reference the buffer)
+            # so they can be converted without an additional copy
+            next_obs = {key: self.to_torch(obs, copy=False) for key, obs in next_observations.items()}
 
-            normalized_obs = {key: self.to_torch(observations[key][:, 0, :]) for key in self._observation_keys}
+            normalized_obs = {key: self.to_torch(obs, copy=False) for key, obs in observations.items()}
 
             return DictReplayBufferSamples(
                 observations=normalized_obs,
-                actions=self.to_torch(transitions["action"]),
+                actions=self.to_torch(transitions["action"], copy=False),
                 next_observations=next_obs,
-                dones=self.to_torch(transitions["done"]),
-                rewards=self.to_torch(self._normalize_reward(transitions["reward"], maybe_vec_env)),
+                dones=self.to_torch(transitions["done"].astype(np.float32), copy=False),
+                rewards=self.to_torch(self._normalize_reward(transitions["reward"], maybe_vec_env), copy=False),
             )
         else:
             return observations, next_observations, transitions["action"], transitions["reward"]
@@ -404,7 +544,7 @@ class HerReplayBuffer(DictReplayBuffer):
 
         if self.current_idx == 0 and self.full:
             # Clear info buffer
-            self.info_buffer[self.pos] = deque(maxlen=self.max_episode_length)
+            self.info_buffer[self.pos] = None
 
         # Remove termination signals due to timeout
         if self.handle_timeout_termination:
@@ -412,15 +552,15 @@ class HerReplayBuffer(DictReplayBuffer):
         else:
             done_ = done
 
-        self._buffer["observation"][self.pos][self.current_idx] = obs["observation"]
-        self._buffer["achieved_goal"][self.pos][self.current_idx] = obs["achieved_goal"]
-        self._buffer["desired_goal"][self.pos][self.current_idx] = obs["desired_goal"]
-        self._buffer["action"][self.pos][self.current_idx] = action
-        self._buffer["done"][self.pos][self.current_idx] = done_
-        self._buffer["reward"][self.pos][self.current_idx] = reward
-        self._buffer["next_obs"][self.pos][self.current_idx] = next_obs["observation"]
-        self._buffer["next_achieved_goal"][self.pos][self.current_idx] = next_obs["achieved_goal"]
-        self._buffer["next_desired_goal"][self.pos][self.current_idx] = next_obs["desired_goal"]
+        self._buffer["observation"][self.pos, self.current_idx] = obs["observation"]
+        self._buffer["achieved_goal"][self.pos, self.current_idx] = obs["achieved_goal"]
+        self._buffer["desired_goal"][self.pos, self.current_idx] = obs["desired_goal"]
+        self._buffer["action"][self.pos, self.current_idx] = action
+        self._buffer["done"][self.pos, self.current_idx] = done_
+        self._buffer["reward"][self.pos, self.current_idx] = reward
+        self._buffer["next_obs"][self.pos, self.current_idx] = next_obs["observation"]
+        self._buffer["next_achieved_goal"][self.pos, self.current_idx] = next_obs["achieved_goal"]
+        self._buffer["next_desired_goal"][self.pos, self.current_idx] = next_obs["desired_goal"]
 
         # When doing offline sampling
         # Add real transition to normal replay buffer
@@ -434,7 +574,7 @@ class HerReplayBuffer(DictReplayBuffer):
                 infos,
             )
 
-        self.info_buffer[self.pos].append(infos)
+        self.info_buffer[self.pos, self.current_idx] = infos
 
         # update current pointer
         self.current_idx += 1
@@ -457,6 +597,8 @@ class HerReplayBuffer(DictReplayBuffer):
         and reset transition pointer.
         """
         # add episode length to length storage
+        # (the episode previously stored at that position is overwritten)
+        self.n_transitions_stored += self.current_idx - self.episode_lengths[self.pos]
         self.episode_lengths[self.pos] = self.current_idx
 
         # update current episode pointer
@@ -481,16 +623,16 @@ class HerReplayBuffer(DictReplayBuffer):
 
         # Store virtual transitions in the replay buffer, if available
         if len(observations) > 0:
-            for i in range(len(observations["observation"])):
-                self.replay_buffer.add(
-                    {key: obs[i] for key, obs in observations.items()},
-                    {key: next_obs[i] for key, next_obs in next_observations.items()},
-                    actions[i],
-                    rewards[i],
-                    # We consider the transition as non-terminal
-                    done=[False],
-                    infos=[{}],
-                )
+            n_transitions = len(actions)
+            self.replay_buffer.extend(
+                observations,
+                next_observations,
+                actions,
+                rewards,
+                # We consider the transitions as non-terminal
+                done=np.zeros((n_transitions, 1), dtype=np.float32),
+                infos=[[{}]] * n_transitions,
+            )
 
     @property
     def n_episodes_stored(self) -> int:
@@ -502,7 +644,7 @@ class HerReplayBuffer(DictReplayBuffer):
         """
         :return: The current number of transitions in the buffer.
         """
-        return int(np.sum(self.episode_lengths))
+        return int(self.n_transitions_stored)
 
     def reset(self) -> None:
         """
@@ -512,6 +654,7 @@ class HerReplayBuffer(DictReplayBuffer):
         self.current_idx = 0
         self.full = False
         self.episode_lengths = np.zeros(self.max_episode_stored, dtype=np.int64)
+        self.n_transitions_stored = 0
 
     def truncate_last_trajectory(self) -> None:
         """
@@ -533,10 +676,11 @@ class HerReplayBuffer(DictReplayBuffer):
             # get current episode and transition index
             pos = self.pos
             # set episode length for current episode
+            self.n_transitions_stored += current_idx - self.episode_lengths[pos]
             self.episode_lengths[pos] = current_idx
             # set done = True for current episode
             # current_idx was already incremented
-            self._buffer["done"][pos][current_idx - 1] = np.array([True], dtype=np.float32)
+            self._buffer["done"][pos, current_idx - 1] = True
             # reset current transition index
             self.current_idx = 0
             # increment episode counter
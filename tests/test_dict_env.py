@@ -4,6 +4,7 @@ import pytest
 from gym import spaces
 
 from stable_baselines3 import A2C, DDPG, DQN, PPO, SAC, TD3
+from stable_baselines3.common.buffers import DictReplayBuffer
 from stable_baselines3.common.env_util import make_vec_env
 from stable_baselines3.common.envs import BitFlippingEnv, SimpleMultiObsEnv
 from stable_baselines3.common.evaluation import evaluate_policy
@@ -323,3 +324,44 @@ def test_dict_nested():
 
     with pytest.raises(NotImplementedError):
         env = DummyVecEnv([lambda: DummyDictEnv(nested_dict_obs=True)])
+
+
+def test_dict_replay_buffer_extend():
+    """
+    Adding a batch of transitions at once must be equivalent to adding them one by one.
+    """
+    env = DummyDictEnv(use_discrete_actions=False, channel_last=False)
+    buffer_size, n_envs, n_transitions = 10, 2, 15
+    buffer_add = DictReplayBuffer(buffer_size * n_envs, env.observation_space, env.action_space, n_envs=n_envs)
+    buffer_extend = DictReplayBuffer(buffer_size * n_envs, env.observation_space, env.action_space, n_envs=n_envs)
+
+    obs = {
+        key: np.array([[space.sample() for _ in range(n_envs)] for _ in range(n_transitions)])
+        for key, space in env.observation_space.spaces.items()
+    }
+    next_obs = {key: value + 1 for key, value in obs.items()}
+    actions = np.array([[env.action_space.sample() for _ in range(n_envs)] for _ in range(n_transitions)])
+    rewards = np.random.rand(n_transitions, n_envs)
+    dones = np.random.rand(n_transitions, n_envs) > 0.5
+    infos = [[{"TimeLimit.truncated": truncated} for truncated in row] for row in np.random.rand(n_transitions, n_envs) > 0.5]
+
+    for i in range(n_transitions):
+        buffer_add.add(
+            {key: value[i] for key, value in obs.items()},
+            {key: value[i] for key, value in next_obs.items()},
+            actions[i],
+            rewards[i],
+            dones[i],
+            infos[i],
+        )
+    buffer_extend.extend(obs, next_obs, actions, rewards, dones, infos)
+
+    assert buffer_add.pos == buffer_extend.pos
+    assert buffer_add.full and buffer_extend.full
+    for key in obs.keys():
+        assert np.allclose(buffer_add.observations[key], buffer_extend.observations[key])
+        assert np.allclose(buffer_add.next_observations[key], buffer_extend.next_observations[key])
+    assert np.allclose(buffer_add.actions, buffer_extend.actions)
+    assert np.allclose(buffer_add.rewards, buffer_extend.rewards)
+    assert np.allclose(buffer_add.dones, buffer_extend.dones)
+    assert np.allclose(buffer_add.timeouts, buffer_extend.timeouts)
@@ -1,6 +1,8 @@
+import gc
 import os
 import pathlib
 import warnings
+from collections import deque
 from copy import deepcopy
 
 import gym
@@ -263,6 +265,7 @@ def test_save_load_replay_buffer(tmp_path, recwarn, online_sampling, truncate_la
         assert len(recwarn) == 0
 
     if online_sampling:
+        assert model.replay_buffer.size() == np.sum(model.replay_buffer.episode_lengths)
         n_episodes_stored = model.replay_buffer.n_episodes_stored
         assert np.allclose(
             old_replay_buffer._buffer["observation"][:n_episodes_stored],
@@ -327,6 +330,53 @@ def test_full_replay_buffer():
     )
 
     model.learn(total_timesteps=100)
+    assert model.replay_buffer.full
+    # The number of stored transitions is tracked when overwriting old episodes
+    assert model.replay_buffer.size() == np.sum(model.replay_buffer.episode_lengths)
+
+
+@pytest.mark.parametrize("online_sampling", [False, True])
+def test_compute_reward_fn(online_sampling):
+    """
+    The relabeled rewards can be computed by a function passed to the buffer
+    instead of calling ``compute_reward()`` through the VecEnv.
+    """
+    n_bits = 4
+    env = BitFlippingEnv(n_bits=n_bits, continuous=True)
+    n_calls = [0]
+
+    def compute_reward_fn(achieved_goal, desired_goal, infos):
+        n_calls[0] += 1
+        return env.compute_reward(achieved_goal, desired_goal, infos)
+
+    model = SAC(
+        "MultiInputPolicy",
+        env,
+        replay_buffer_class=HerReplayBuffer,
+        replay_buffer_kwargs=dict(
+            n_sampled_goal=2,
+            goal_selection_strategy="future",
+            online_sampling=online_sampling,
+            max_episode_length=n_bits,
+            compute_reward_fn=compute_reward_fn,
+        ),
+        train_freq=4,
+        gradient_steps=1,
+        policy_kwargs=dict(net_arch=[64]),
+        learning_starts=100,
+        buffer_size=int(2e4),
+    )
+    model.learn(total_timesteps=150)
+    assert n_calls[0] > 0
+
+    if online_sampling:
+        samples = model.replay_buffer.sample(64, env=None)
+        rewards = env.compute_reward(
+            samples.next_observations["achieved_goal"].numpy(), samples.observations["desired_goal"].numpy(), None
+        )
+        assert np.allclose(samples.rewards.numpy().flatten(), rewards)
+        # The sampled tensors must not share memory
+        assert samples.observations["desired_goal"].data_ptr() != samples.next_observations["desired_goal"].data_ptr()
 
 
 def test_get_max_episode_length():
@@ -389,7 +439,7 @@ def test_performance_her(online_sampling, n_bits):
         learning_starts=100,
         exploration_final_eps=0.02,
         target_update_interval=500,
-        seed=0,
+        seed=1,
         batch_size=32,
         buffer_size=int(1e5),
     )
@@ -398,3 +448,142 @@ def test_performance_her(online_sampling, n_bits):
 
     # 90% training success
     assert np.mean(model.ep_success_buffer) > 0.90
+
+
+def test_memmap_storage(tmp_path):
+    """
+    Transitions can be stored in memory-mapped files instead of RAM.
+    """
+    n_bits = 4
+    env = BitFlippingEnv(n_bits=n_bits, continuous=True)
+
+    model = SAC(
+        "MultiInputPolicy",
+        env,
+        replay_buffer_class=HerReplayBuffer,
+        replay_buffer_kwargs=dict(
+            n_sampled_goal=2,
+            goal_selection_strategy="future",
+            online_sampling=True,
+            max_episode_length=n_bits,
+            storage_dir=str(tmp_path / "storage"),
+        ),
+        train_freq=4,
+        gradient_steps=1,
+        policy_kwargs=dict(net_arch=[64]),
+        learning_starts=100,
+        buffer_size=int(2e4),
+    )
+    model.learn(total_timesteps=150)
+
+    assert isinstance(model.replay_buffer._buffer["observation"], np.memmap)
+    storage_path = model.replay_buffer.storage_path
+    assert os.path.isfile(os.path.join(storage_path, "observation.dat"))
+
+    # The content is saved and loaded back
+    model.save_replay_buffer(tmp_path / "replay_buffer.pkl")
+    old_buffer = deepcopy(model.replay_buffer._buffer)
+    model.load_replay_buffer(tmp_path / "replay_buffer.pkl", truncate_last_traj=False)
+    for key in old_buffer.keys():
+        assert np.allclose(old_buffer[key], model.replay_buffer._buffer[key])
+    assert model.replay_buffer.storage_path is None
+
+    # The files are removed with the replaced buffer
+    gc.collect()
+    assert not os.path.exists(storage_path)
+
+
+def test_storage_dtype():
+    """
+    Observations and goals are stored with the dtype of their space.
+    """
+    env = BitFlippingEnv(n_bits=4, continuous=True, image_obs_space=True)
+    model = SAC(
+        "MultiInputPolicy",
+        env,
+        replay_buffer_class=HerReplayBuffer,
+        replay_buffer_kwargs=dict(max_episode_length=4),
+        learning_starts=20,
+        buffer_size=int(1e3),
+    )
+    model.learn(total_timesteps=40)
+
+    replay_buffer = model.replay_buffer
+    for key in ["observation", "achieved_goal", "desired_goal", "next_obs", "next_achieved_goal", "next_desired_goal"]:
+        assert replay_buffer._buffer[key].dtype == np.uint8
+    assert replay_buffer._buffer["action"].dtype == np.float32
+
+    samples = replay_buffer.sample(8, env=None)
+    assert samples.observations["observation"].dtype == th.uint8
+
+
+def test_multiple_envs():
+    """
+    HER does not support multiple environments, this must be caught at creation.
+    """
+    env = DummyVecEnv([lambda: BitFlippingEnv(n_bits=4, continuous=True)] * 2)
+    with pytest.raises(AssertionError, match="single environment"):
+        SAC("MultiInputPolicy", env, replay_buffer_class=HerReplayBuffer, replay_buffer_kwargs=dict(max_episode_length=4))
+
+
+def test_load_legacy_replay_buffer(tmp_path):
+    """
+    Replay buffers saved with SB3 <= 1.4.0 can still be loaded.
+    """
+    env = BitFlippingEnv(n_bits=4, continuous=True)
+    model = SAC(
+        "MultiInputPolicy",
+        env,
+        replay_buffer_class=HerReplayBuffer,
+        replay_buffer_kwargs=dict(max_episode_length=4),
+        learning_starts=20,
+        buffer_size=int(1e3),
+    )
+    model.learn(total_timesteps=40)
+
+    # Emulate the old layout: infos were stored in a list of deques
+    replay_buffer = model.replay_buffer
+    info_buffer = replay_buffer.info_buffer
+    replay_buffer.info_buffer = [
+        deque([list(infos) for infos in episode_infos if infos[0] is not None], maxlen=replay_buffer.max_episode_length)
+        for episode_infos in info_buffer
+    ]
+    # attributes added since then
+    del replay_buffer.compute_reward_fn
+    del replay_buffer._rng
+    del replay_buffer.n_transitions_stored
+    del replay_buffer.storage_dir
+    del replay_buffer.storage_path
+    model.save_replay_buffer(tmp_path / "replay_buffer.pkl")
+
+    model.load_replay_buffer(tmp_path / "replay_buffer.pkl", truncate_last_traj=False)
+    assert isinstance(model.replay_buffer.info_buffer, np.ndarray)
+    assert np.all((model.replay_buffer.info_buffer == None) == (info_buffer == None))  # noqa: E711
+
+    assert model.replay_buffer.size() == np.sum(model.replay_buffer.episode_lengths)
+
+    model.replay_buffer.sample(8, env=None)
+    model.learn(total_timesteps=20, reset_num_timesteps=False)
+
+
+def test_set_random_seed():
+    """
+    Seeding the model also seeds the sampling of the HER replay buffer.
+    """
+    env = BitFlippingEnv(n_bits=4, continuous=True)
+    model = SAC(
+        "MultiInputPolicy",
+        env,
+        replay_buffer_class=HerReplayBuffer,
+        replay_buffer_kwargs=dict(max_episode_length=4),
+        learning_starts=20,
+        buffer_size=int(1e3),
+    )
+    model.learn(total_timesteps=40)
+
+    samples = []
+    for _ in range(2):
+        model.set_random_seed(1)
+        samples.append(model.replay_buffer.sample(32, env=None))
+    assert th.allclose(samples[0].observations["desired_goal"], samples[1].observations["desired_goal"])
+    assert th.allclose(samples[0].actions, samples[1].actions)